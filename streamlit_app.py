@@ -1,16 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
+import tempfile
+
+import numpy as np
 import streamlit as st
 
 from strudel_converter.audio_tools import (
-    download_audio,
-    extract_features,
+    extract_features_cached,
+    extract_onsets,
     is_supported_file,
-    load_audio,
+    load_audio_bytes,
     note_sequence_from_pitch_track,
+    separate_hpss,
     separate_stems,
+    separation_backend,
     SUPPORTED_EXTENSIONS,
-    save_upload_to_temp,
+    stream_audio,
 )
 from strudel_converter.strudel_generator import build_strudel_result
 
@@ -22,33 +28,85 @@ st.title("Strudel Converter")
 st.caption("Turn videos and audio into playable Strudel code")
 
 
-def _analyze(audio_path: Path):
+# below this length stem separation costs far more than the analysis it feeds
+MIN_STEM_SECONDS = 20.0
+# st.cache_data is shared by every session; decoded waveforms can be gigabytes
+MAX_CACHED_AUDIO = 4
+# features for a mixture plus up to four stems per conversion
+MAX_CACHED_FEATURES = 8 * 5
+
+
+def _session_tmp() -> Path:
+    # one directory per browser session; TemporaryDirectory removes it when the
+    # session state is dropped or the process exits
+    if "tmp" not in st.session_state:
+        st.session_state["tmp"] = tempfile.TemporaryDirectory(prefix="strudel_")
+    return Path(st.session_state["tmp"].name)
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_AUDIO)
+def _cached_upload(upload_bytes: bytes, filename: str):
+    # keyed by the upload contents, so re-converting the same file skips decoding
+    return load_audio_bytes(upload_bytes, filename)
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_AUDIO)
+def _cached_stream(url: str):
+    return stream_audio(url)
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_FEATURES)
+def _cached_features(y: np.ndarray, sr: int):
+    return extract_features_cached(y, sr)
+
+
+def _analyze_one_stem(item):
+    name, (stem_audio, stem_sr) = item
+    stem_features = _cached_features(stem_audio, stem_sr)
+    stem_features["notes"] = note_sequence_from_pitch_track(
+        stem_features["pitches"],
+        frame_times=stem_features["frame_times"],
+        onset_times=stem_features["onset_times"],
+    )
+    return name, stem_features
+
+
+def _analyze_stems(y: np.ndarray, sr: int, ex: ThreadPoolExecutor):
+    if len(y) / sr < MIN_STEM_SECONDS:
+        logger.info("Clip shorter than %.0fs, skipping stem separation", MIN_STEM_SECONDS)
+        return {}
+    if st.session_state.get("stem_mode", "fast") == "model":
+        stems = separate_stems(y, sr)
+        return dict(ex.map(_analyze_one_stem, stems.items()))
+    # HPSS only yields a drum part, and the generator only reads its onsets
+    drums, drums_sr = separate_hpss(y, sr)["drums"]
+    return {"drums": extract_onsets(drums, drums_sr)}
+
+
+def _analyze(y: np.ndarray, sr: int):
     with st.spinner("Analyzing audio..."):
-        y, sr = load_audio(audio_path)
-        features = extract_features(y, sr)
         stem_payload = {}
 
-        try:
-            stems = separate_stems(audio_path)
-            for name, (stem_audio, stem_sr) in stems.items():
-                stem_features = extract_features(stem_audio, stem_sr)
-                stem_features["notes"] = note_sequence_from_pitch_track(
-                    stem_features["pitches"],
-                    sr=stem_sr,
-                    onset_times=stem_features["onset_times"],
-                )
-                stem_payload[name] = stem_features
-        except Exception as exc:  # pragma: no cover - optional path
-            logger.warning("Stem separation failed: %s", exc)
+        with ThreadPoolExecutor() as ex:
+            # overlap the mixture analysis with stem separation
+            features_future = ex.submit(_cached_features, y, sr)
+            if st.session_state.get("do_stems", True):
+                try:
+                    stem_payload = _analyze_stems(y, sr, ex)
+                except Exception as exc:  # pragma: no cover - optional path
+                    logger.warning("Stem separation failed: %s", exc)
+            features = features_future.result()
 
         result = build_strudel_result(
             tempo=float(features["tempo"][0]),
             chroma=features["chroma"],
             pitches=features["pitches"],
+            frame_times=features["frame_times"],
             sr=sr,
             onset_times=features["onset_times"],
             audio=y,
             stems=stem_payload,
+            preview_dir=_session_tmp(),
         )
     return result
 
@@ -61,8 +119,8 @@ def _download_section():
             st.warning("Please provide a URL to download audio from.")
             return
         try:
-            audio_file = download_audio(url)
-            result = _analyze(audio_file)
+            y, sr = _cached_stream(url)
+            result = _analyze(y, sr)
             st.success("Conversion complete!")
             st.code(result.to_code(), language="haskell")
             if result.preview_path:
@@ -85,10 +143,10 @@ def _upload_section():
         st.error("Unsupported file type")
         return
 
-    temp_path = save_upload_to_temp(uploaded.getbuffer(), uploaded.name)
     if st.button("Convert upload", type="primary"):
         try:
-            result = _analyze(temp_path)
+            y, sr = _cached_upload(uploaded.getvalue(), uploaded.name)
+            result = _analyze(y, sr)
             st.success("Conversion complete!")
             st.code(result.to_code(), language="haskell")
             if result.preview_path:
@@ -103,12 +161,26 @@ with st.sidebar:
         """
         ### How it works
         1. Paste a YouTube or video/audio URL **or** upload a file.
-        2. The app downloads the audio, extracts rhythm & pitch cues (tempo, onsets, chroma, YIN pitch).
+        2. The app downloads the audio, extracts rhythm & pitch cues (tempo, onsets, chroma, and pitch via pyworld DIO or librosa YIN).
         3. It generates Strudel code with stacked note and percussive patterns, tempo metadata, and a preview clip.
 
         The output favors musical structure by snapping transients to a step grid and prioritizing repeated notes for motifs.
         """
     )
+    st.checkbox(
+        "Separate stems",
+        value=True,
+        key="do_stems",
+        help="Analyze separated parts to refine drums, bass and lead.",
+    )
+    backend_name = "ONNX Runtime" if separation_backend() == "onnx" else "Spleeter"
+    st.radio(
+        "Stem quality",
+        options=["fast", "model"],
+        format_func={"fast": "Fast (HPSS drums)", "model": f"Model separation ({backend_name}, slow)"}.get,
+        key="stem_mode",
+        help=f"Stems are separated only for clips of {MIN_STEM_SECONDS:.0f}s or longer.",
+    )
     st.markdown(
         """**Tip:** You can paste the generated snippet into the [Strudel playground](https://strudel.cc/playground/) and swap instruments or effects as needed."""
     )
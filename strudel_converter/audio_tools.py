@@ -1,93 +1,226 @@
+import functools
+import hashlib
+import io
 import logging
+import os
+import subprocess
 import tempfile
+import threading
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import librosa
 import numpy as np
 import soundfile as sf
-import yt_dlp
+import soxr
 
-try:  # optional dependency; unavailable on Py>=3.11
-    from spleeter.separator import Separator  # type: ignore
-    _SPLEETER_IMPORT_ERROR: str | None = None
-except Exception as exc:  # pragma: no cover - import guard
-    Separator = None  # type: ignore
-    _SPLEETER_IMPORT_ERROR = str(exc)
+# librosa, yt_dlp, spleeter (TensorFlow) and onnxruntime are imported inside the functions
+# that need them so the Streamlit page renders without paying their import cost.
 
 logger = logging.getLogger(__name__)
 
 
+def _configure_tensorflow_gpu() -> None:
+    """Let TensorFlow grow GPU memory on demand; Spleeter then runs on CUDA when present."""
+    try:
+        import tensorflow as tf  # type: ignore
+
+        gpus = tf.config.list_physical_devices("GPU")
+        for gpu in gpus:
+            tf.config.experimental.set_memory_growth(gpu, True)
+    except Exception as exc:  # pragma: no cover - depends on host GPU setup
+        logger.info("TensorFlow GPU setup skipped, using CPU: %s", exc)
+        return
+    if gpus:
+        logger.info("Spleeter will use %d GPU(s)", len(gpus))
+
+
+_Separator = None
+_SPLEETER_IMPORT_ERROR: Optional[str] = None
+
+
+def _spleeter_separator_class():
+    """Import Spleeter on first use, remembering the class or the import failure."""
+    global _Separator, _SPLEETER_IMPORT_ERROR
+    if _Separator is None and _SPLEETER_IMPORT_ERROR is None:
+        try:  # optional dependency; unavailable on Py>=3.11
+            from spleeter.separator import Separator  # type: ignore
+        except Exception as exc:  # pragma: no cover - import guard
+            _SPLEETER_IMPORT_ERROR = str(exc)
+        else:
+            _configure_tensorflow_gpu()
+            _Separator = Separator
+    return _Separator
+
+
+try:  # optional dependency; falls back to librosa.yin
+    import pyworld  # type: ignore
+except Exception:  # pragma: no cover - import guard
+    pyworld = None  # type: ignore
+
+
 SUPPORTED_EXTENSIONS = {".wav", ".mp3", ".ogg", ".flac", ".aac", ".m4a", ".mp4", ".mov"}
 
+# Analysis rate: onsets, chroma and C2-C7 pitch need nothing above 11 kHz.
+ANALYSIS_SR = 22050
+# Spleeter's pretrained models operate on 44.1 kHz audio.
+SPLEETER_SR = 44100
+
+FEATURE_CACHE_DIR = Path.home() / ".cache" / "strudel"
+# Bump whenever extract_features changes its output so stale cache entries are ignored.
+FEATURES_VERSION = 1
+# Oldest entries beyond this count are evicted from FEATURE_CACHE_DIR after each write.
+MAX_FEATURE_CACHE_ENTRIES = 256
+ONNX_MODEL_DIR = FEATURE_CACHE_DIR / "models"
+
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
 
 def is_supported_file(filename: str) -> bool:
     return Path(filename).suffix.lower() in SUPPORTED_EXTENSIONS
 
 
-def download_audio(source_url: str) -> Path:
-    """Download audio from a URL (YouTube or direct) into a temporary file."""
-    temp_dir = Path(tempfile.mkdtemp(prefix="strudel_audio_"))
-    output_template = str(temp_dir / "audio.%(ext)s")
+def stream_audio(source_url: str, target_sr: int = ANALYSIS_SR) -> Tuple[np.ndarray, int]:
+    """Decode audio from a URL (YouTube or direct) straight into memory via ffmpeg."""
+    import yt_dlp
 
     ydl_opts = {
         "format": "bestaudio/best",
-        "outtmpl": output_template,
         "quiet": True,
         "noplaylist": True,
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "wav",
-                "preferredquality": "192",
-            }
-        ],
     }
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        logger.info("Downloading audio from %s", source_url)
-        ydl.download([source_url])
+        logger.info("Resolving audio stream for %s", source_url)
+        info = ydl.extract_info(source_url, download=False)
+
+    media_url = info.get("url")
+    if not media_url:
+        raise FileNotFoundError("Failed to resolve an audio stream URL")
 
-    downloaded = next(temp_dir.glob("audio.*"), None)
-    if downloaded is None:
-        raise FileNotFoundError("Failed to download audio file")
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    headers = info.get("http_headers") or {}
+    if headers:
+        cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    cmd += ["-i", media_url, "-vn", "-f", "f32le", "-ac", "1", "-ar", str(target_sr), "pipe:1"]
 
-    return downloaded
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {proc.stderr.decode(errors='replace').strip()}")
 
+    y = np.frombuffer(proc.stdout, dtype=np.float32)
+    if y.size == 0:
+        raise FileNotFoundError("Failed to download audio stream")
+    return y, target_sr
 
-def save_upload_to_temp(upload_bytes: bytes, filename: str) -> Path:
-    """Persist an uploaded file to a temporary path for analysis."""
-    temp_dir = Path(tempfile.mkdtemp(prefix="strudel_upload_"))
+
+def save_upload_to_temp(upload_bytes: bytes, filename: str, base_dir: Optional[Path] = None) -> Path:
+    """Persist an uploaded file to ``base_dir`` (or a fresh temporary directory) for analysis."""
+    temp_dir = Path(base_dir) if base_dir else Path(tempfile.mkdtemp(prefix="strudel_upload_"))
     target = temp_dir / Path(filename).name
     with open(target, "wb") as f:
         f.write(upload_bytes)
     return target
 
 
-def load_audio(audio_path: Path, target_sr: int = 44100) -> Tuple[np.ndarray, int]:
-    """Load an audio file with librosa, resampling as needed."""
-    y, sr = librosa.load(audio_path, sr=target_sr, mono=True)
-    return y, sr
+def _to_mono_float32(data: np.ndarray, sr_native: int, target_sr: int) -> Tuple[np.ndarray, int]:
+    if data.ndim > 1:
+        data = data.mean(axis=1, dtype=np.float32)
+    if sr_native != target_sr:
+        data = soxr.resample(data, sr_native, target_sr)
+    return data, target_sr
+
+
+def load_audio(audio_path: Path, target_sr: int = ANALYSIS_SR) -> Tuple[np.ndarray, int]:
+    """Load an audio file as float32 mono, resampling as needed.
+
+    Decodes with soundfile when it understands the container and falls back to
+    librosa (audioread/ffmpeg) for formats such as mp4 or aac.
+    """
+    try:
+        data, sr_native = sf.read(str(audio_path), dtype="float32", always_2d=False)
+    except RuntimeError:
+        import librosa
+
+        y, sr = librosa.load(audio_path, sr=target_sr, mono=True, dtype=np.float32)
+        return y, sr
+    return _to_mono_float32(data, sr_native, target_sr)
+
+
+def load_audio_bytes(
+    upload_bytes: bytes, filename: str, target_sr: int = ANALYSIS_SR
+) -> Tuple[np.ndarray, int]:
+    """Decode uploaded bytes in memory, spilling to a temporary file only when soundfile can't read them."""
+    try:
+        data, sr_native = sf.read(io.BytesIO(upload_bytes), dtype="float32", always_2d=False)
+    except RuntimeError:
+        with tempfile.TemporaryDirectory(prefix="strudel_upload_") as tmp:
+            return load_audio(save_upload_to_temp(upload_bytes, filename, base_dir=Path(tmp)), target_sr)
+    return _to_mono_float32(data, sr_native, target_sr)
+
+
+def _pitch_track(y: np.ndarray, sr: int, hop_length: int = 512) -> np.ndarray:
+    """Estimate f0 per frame; unvoiced frames are reported as 0 Hz."""
+    import librosa
+
+    fmin = librosa.note_to_hz("C2")
+    fmax = librosa.note_to_hz("C7")
+
+    if pyworld is None:
+        return librosa.yin(
+            y,
+            fmin=fmin,
+            fmax=fmax,
+            sr=sr,
+            frame_length=2048,
+            hop_length=hop_length,
+        )
+
+    # DIO + StoneMask is much faster than YIN; match librosa's frame grid.
+    x = np.ascontiguousarray(y, dtype=np.float64)
+    f0, t = pyworld.dio(
+        x,
+        sr,
+        f0_floor=fmin,
+        f0_ceil=fmax,
+        frame_period=1000.0 * hop_length / sr,
+    )
+    return pyworld.stonemask(x, f0, t, sr)
 
 
-def extract_features(y: np.ndarray, sr: int) -> Dict[str, np.ndarray]:
-    """Compute useful features for rhythm and pitch estimation."""
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
+def _onsets_from_power(S: np.ndarray, sr: int, hop_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Onset envelope and backtracked onset times from a power spectrogram."""
+    import librosa
 
+    mel = librosa.feature.melspectrogram(S=S, sr=sr)
+    onset_env = librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=sr, hop_length=hop_length)
     onset_times = librosa.onset.onset_detect(
-        onset_envelope=onset_env, sr=sr, units="time", backtrack=True
+        onset_envelope=onset_env, sr=sr, hop_length=hop_length, units="time", backtrack=True
     )
+    return onset_env, onset_times
 
-    pitches = librosa.yin(
-        y,
-        fmin=librosa.note_to_hz("C2"),
-        fmax=librosa.note_to_hz("C7"),
-        sr=sr,
-        frame_length=2048,
-    )
 
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
+def extract_onsets(y: np.ndarray, sr: int, hop_length: int = 512) -> Dict[str, np.ndarray]:
+    """Compute only the onset envelope and onset times, for stems used purely for rhythm."""
+    import librosa
+
+    S = np.abs(librosa.stft(y, n_fft=2048, hop_length=hop_length)) ** 2
+    onset_env, onset_times = _onsets_from_power(S, sr, hop_length)
+    return {"onset_env": onset_env, "onset_times": onset_times}
+
+
+def extract_features(y: np.ndarray, sr: int, hop_length: int = 512) -> Dict[str, np.ndarray]:
+    """Compute useful features for rhythm and pitch estimation."""
+    import librosa
+
+    # One STFT feeds the onset envelope, beats, onsets and chroma; every stage
+    # shares hop_length so their frames line up with the pitch track.
+    S = np.abs(librosa.stft(y, n_fft=2048, hop_length=hop_length)) ** 2
+    onset_env, onset_times = _onsets_from_power(S, sr, hop_length)
+    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+
+    pitches = _pitch_track(y, sr, hop_length=hop_length)
+
+    chroma = librosa.feature.chroma_stft(S=S, sr=sr)
 
     return {
         "onset_env": onset_env,
@@ -95,79 +228,194 @@ def extract_features(y: np.ndarray, sr: int) -> Dict[str, np.ndarray]:
         "beat_frames": beat_frames,
         "onset_times": onset_times,
         "pitches": pitches,
+        "frame_times": librosa.frames_to_time(np.arange(pitches.shape[-1]), sr=sr, hop_length=hop_length),
         "chroma": chroma,
     }
 
 
-def separate_stems(audio_path: Path, stems: str = "spleeter:4stems") -> Dict[str, Tuple[np.ndarray, int]]:
-    """Use Spleeter to separate stems and return loaded arrays keyed by instrument."""
-    if Separator is None:
+def extract_features_cached(
+    y: np.ndarray, sr: int, hop_length: int = 512, cache_dir: Path = FEATURE_CACHE_DIR
+) -> Dict[str, np.ndarray]:
+    """``extract_features`` backed by an on-disk cache keyed by a hash of the audio.
+
+    The key also covers everything else that changes the output: the analysis
+    settings, the pitch backend and ``FEATURES_VERSION``.
+    """
+    pitch_backend = "dio" if pyworld is not None else "yin"
+    digest = hashlib.sha256(np.ascontiguousarray(y).tobytes())
+    digest.update(f"{FEATURES_VERSION}:{y.dtype}:{sr}:{hop_length}:{pitch_backend}".encode())
+    cache_path = Path(cache_dir) / f"{digest.hexdigest()[:16]}.npz"
+
+    if cache_path.exists():
+        try:
+            with np.load(cache_path) as cached:
+                features = {key: cached[key] for key in cached.files}
+            os.utime(cache_path)  # mark as recently used for eviction
+            return features
+        except Exception as exc:  # corrupt or truncated entry; recompute below
+            logger.warning("Ignoring unreadable feature cache %s: %s", cache_path, exc)
+
+    features = extract_features(y, sr, hop_length=hop_length)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.parent / f"{cache_path.name}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **features)
+        os.replace(tmp_path, cache_path)
+        _evict_feature_cache(cache_path.parent)
+    except OSError as exc:
+        logger.warning("Could not write feature cache %s: %s", cache_path, exc)
+    return features
+
+
+def _evict_feature_cache(cache_dir: Path, max_entries: int = MAX_FEATURE_CACHE_ENTRIES) -> None:
+    """Delete the least recently used cache entries beyond ``max_entries``."""
+    entries = []
+    for path in cache_dir.glob("*.npz"):
+        try:
+            entries.append((path.stat().st_mtime, path))
+        except OSError:  # removed concurrently
+            continue
+    entries.sort(reverse=True)
+    for _, path in entries[max_entries:]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+class OnnxSeparator:
+    """Stem separator backed by an ONNX export of the Spleeter U-Net, run with onnxruntime.
+
+    The model must take a float32 ``(n_samples, 2)`` waveform at 44.1 kHz and emit one
+    ``(n_samples, 2)`` waveform per stem, named after the stem (``vocals``, ``drums``,
+    ...), i.e. the same contract as ``Separator.separate``.
+    """
+
+    def __init__(self, model_path: Path):
+        import onnxruntime as ort  # type: ignore
+
+        if not Path(model_path).exists():
+            raise FileNotFoundError(f"ONNX separation model not found at {model_path}")
+
+        preferred = ["CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
+        available = ort.get_available_providers()
+        providers = [p for p in preferred if p in available] or available
+        self.session = ort.InferenceSession(str(model_path), providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def separate(self, waveform: np.ndarray) -> Dict[str, np.ndarray]:
+        outputs = self.session.run(
+            self.output_names, {self.input_name: np.ascontiguousarray(waveform, dtype=np.float32)}
+        )
+        return dict(zip(self.output_names, outputs))
+
+
+# Cached separators are shared by every Streamlit session thread, and Spleeter's
+# separate() feeds a shared data generator, so inference must be serialized.
+_SEPARATE_LOCK = threading.Lock()
+
+
+def separation_backend() -> str:
+    """Name of the model separation backend selected by ``STRUDEL_BACKEND``: ``onnx`` or ``spleeter``."""
+    return "onnx" if os.environ.get("STRUDEL_BACKEND", "spleeter").lower() == "onnx" else "spleeter"
+
+
+@functools.lru_cache(maxsize=4)
+def get_separator(stems: str = "spleeter:4stems"):
+    """Return a separator for ``stems``, loading the model only once per process.
+
+    ``STRUDEL_BACKEND=onnx`` selects :class:`OnnxSeparator` with the model
+    ``<STRUDEL_ONNX_MODEL_DIR>/<stems>.onnx`` (e.g. ``4stems.onnx``); the default is Spleeter.
+    """
+    if separation_backend() == "onnx":
+        model_dir = Path(os.environ.get("STRUDEL_ONNX_MODEL_DIR", ONNX_MODEL_DIR))
+        return OnnxSeparator(model_dir / f"{stems.split(':')[-1]}.onnx")
+
+    separator_cls = _spleeter_separator_class()
+    if separator_cls is None:
         raise RuntimeError(
             "Spleeter is unavailable. Install on Python 3.8-3.10 and pin protobuf<=3.20.x. "
             f"Import error: {_SPLEETER_IMPORT_ERROR}"
         )
+    return separator_cls(stems)
 
-    temp_dir = Path(tempfile.mkdtemp(prefix="strudel_stems_"))
-    separator = Separator(stems)
 
-    separator.separate_to_file(
-        str(audio_path),
-        str(temp_dir),
-        filename_format="{filename}/{instrument}.wav",
-    )
+def separate_stems(
+    y: np.ndarray,
+    sr: int,
+    stems: str = "spleeter:4stems",
+    separator=None,
+) -> Dict[str, Tuple[np.ndarray, int]]:
+    """Separate an in-memory mixture with Spleeter (or its ONNX export) into arrays keyed by instrument."""
+    import librosa
+
+    if separator is None:
+        separator = get_separator(stems)
+
+    mixture = librosa.resample(y, orig_sr=sr, target_sr=SPLEETER_SR) if sr != SPLEETER_SR else y
+    # Spleeter models expect stereo input; duplicate the mono mixture.
+    with _SEPARATE_LOCK:
+        prediction = separator.separate(np.stack([mixture, mixture], axis=1))
 
-    base_folder = temp_dir / Path(audio_path).stem
     stems_loaded: Dict[str, Tuple[np.ndarray, int]] = {}
-    for stem_file in base_folder.glob("*.wav"):
-        data, stem_sr = sf.read(stem_file)
-        if data.ndim > 1:
-            data = np.mean(data, axis=1)
-        stems_loaded[stem_file.stem] = (data.astype(np.float32), stem_sr)
+    for name, arr in prediction.items():
+        stem = arr.mean(axis=1)
+        if sr != SPLEETER_SR:
+            stem = librosa.resample(stem, orig_sr=SPLEETER_SR, target_sr=sr)
+        stems_loaded[name] = (stem.astype(np.float32), sr)
 
     return stems_loaded
 
 
+def separate_hpss(y: np.ndarray, sr: int) -> Dict[str, Tuple[np.ndarray, int]]:
+    """Extract the percussive part of the mixture with median-filter HPSS.
+
+    A CPU-only stand-in for Spleeter when only the drum pattern needs cleaning up.
+    The harmonic part is discarded since the generator only reads melodic stems
+    from Spleeter; the percussive part is keyed ``drums`` like Spleeter's stem.
+    """
+    import librosa
+
+    y_percussive = librosa.effects.percussive(y)
+    return {"drums": (y_percussive.astype(np.float32), sr)}
+
+
 def dominant_key(chroma: np.ndarray) -> str:
     """Estimate a dominant pitch class from chroma energy."""
-    pitch_classes = [
-        "C",
-        "C#",
-        "D",
-        "D#",
-        "E",
-        "F",
-        "F#",
-        "G",
-        "G#",
-        "A",
-        "A#",
-        "B",
-    ]
     if chroma.size == 0:
         return "C"
     energy = chroma.mean(axis=1)
     idx = int(np.argmax(energy))
-    return pitch_classes[idx]
+    return PITCH_CLASSES[idx]
+
 
+def note_sequence_from_pitch_track(
+    pitches: np.ndarray, frame_times: np.ndarray, onset_times: np.ndarray
+) -> List[str]:
+    """Sample the pitch contour at onset positions and map to note names.
+
+    ``frame_times`` holds the timestamp of each pitch frame, as returned by ``extract_features``.
+    """
+    import librosa
 
-def note_sequence_from_pitch_track(pitches: np.ndarray, sr: int, onset_times: np.ndarray) -> List[str]:
-    """Sample the pitch contour at onset positions and map to note names."""
     if len(pitches) == 0 or len(onset_times) == 0:
         return []
 
-    times = librosa.frames_to_time(np.arange(len(pitches)), sr=sr)
-    notes: List[str] = []
+    idxs = np.clip(np.searchsorted(frame_times, onset_times), 0, len(pitches) - 1)
+    hz = pitches[idxs]
+    hz = hz[np.isfinite(hz) & (hz > 0)]
+    if hz.size == 0:
+        return []
 
-    for onset in onset_times:
-        idx = np.searchsorted(times, onset)
-        if idx >= len(pitches):
-            idx = -1
-        pitch_hz = pitches[idx]
-        if np.isnan(pitch_hz) or pitch_hz <= 0:
-            continue
-        notes.append(librosa.hz_to_note(pitch_hz))
+    return [str(note) for note in librosa.hz_to_note(hz)]
 
-    return notes
+
+def grid_steps(onset_times: np.ndarray, seconds_per_beat: float, grid: int = 16) -> np.ndarray:
+    """Quantize onset times to step indices on a one-bar (4 beat) grid."""
+    beat_positions = np.asarray(onset_times) / seconds_per_beat
+    return np.round((beat_positions % 4) / 4 * grid).astype(int) % grid
 
 
 def grid_rhythm(onset_times: np.ndarray, tempo: float, grid: int = 16) -> List[str]:
@@ -176,21 +424,19 @@ def grid_rhythm(onset_times: np.ndarray, tempo: float, grid: int = 16) -> List[s
         return []
 
     seconds_per_beat = 60.0 / tempo
-    pattern = ["~"] * grid
-
-    for onset in onset_times:
-        beat_position = onset / seconds_per_beat
-        step = int(np.round((beat_position % 4) / 4 * grid)) % grid
-        pattern[step] = "bd"
-
-    return pattern
+    pattern = np.full(grid, "~", dtype=object)
+    pattern[grid_steps(onset_times, seconds_per_beat, grid)] = "bd"
+    return list(pattern)
 
 
-def export_audio_clip(y: np.ndarray, sr: int, duration: float = 12.0) -> Path:
-    """Save a short preview clip for reference."""
+def export_audio_clip(
+    y: np.ndarray, sr: int, duration: float = 12.0, base_dir: Optional[Path] = None
+) -> Path:
+    """Save a short preview clip to ``base_dir`` (or a fresh temporary directory) for reference."""
     samples = int(duration * sr)
-    clip = y[:samples]
-    temp_dir = Path(tempfile.mkdtemp(prefix="strudel_preview_"))
+    # bounded to the preview length; clipping keeps int16 conversion from wrapping
+    clip = np.clip(y[:samples], -1.0, 1.0)
+    temp_dir = Path(base_dir) if base_dir else Path(tempfile.mkdtemp(prefix="strudel_preview_"))
     clip_path = temp_dir / "preview.wav"
-    sf.write(clip_path, clip, sr)
+    sf.write(clip_path, clip, sr, subtype="PCM_16")
     return clip_path
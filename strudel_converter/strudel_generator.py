@@ -3,10 +3,15 @@ import re
 from pathlib import Path
 from typing import Dict, List, Optional, Sequence
 
-import librosa
 import numpy as np
 
-from .audio_tools import dominant_key, export_audio_clip, note_sequence_from_pitch_track
+from .audio_tools import (
+    PITCH_CLASSES,
+    dominant_key,
+    export_audio_clip,
+    grid_steps,
+    note_sequence_from_pitch_track,
+)
 
 
 @dataclass
@@ -120,22 +125,6 @@ stack(drums, pad, bass, lead, riser)
 """
 
 
-PITCH_CLASSES = [
-    "C",
-    "C#",
-    "D",
-    "D#",
-    "E",
-    "F",
-    "F#",
-    "G",
-    "G#",
-    "A",
-    "A#",
-    "B",
-]
-
-
 def _format_note(note: str) -> str:
     match = re.match(r"([A-Ga-g][#b♭♯]?)([-]?\d+)", note.strip())
     if not match:
@@ -157,6 +146,8 @@ def _infer_mode(notes: Sequence[str], root: str) -> str:
     if not notes:
         return "minor"
 
+    import librosa
+
     try:
         root_pc = librosa.note_to_midi(root + "3") % 12
     except Exception:
@@ -228,9 +219,7 @@ def _bass_line(root: str, bass_notes: Optional[Sequence[str]] = None) -> List[st
 def _drum_pattern(onset_times: np.ndarray, tempo: float) -> List[str]:
     pattern = ["~"] * 16
     seconds_per_beat = 60.0 / tempo if tempo > 0 else 0.5
-    for onset in onset_times:
-        beat_position = onset / seconds_per_beat if seconds_per_beat else 0
-        step = int(np.round((beat_position % 4) / 4 * 16)) % 16
+    for step in np.unique(grid_steps(onset_times, seconds_per_beat, 16)):
         pattern[step] = "tr808_bd"
 
     # default backbeat and hats
@@ -254,10 +243,16 @@ def build_strudel_result(
     onset_times: np.ndarray,
     audio: np.ndarray,
     stems: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+    preview_dir: Optional[Path] = None,
+    frame_times: Optional[np.ndarray] = None,
 ) -> StrudelResult:
     stems = stems or {}
     root = dominant_key(chroma)
-    base_notes = note_sequence_from_pitch_track(pitches, sr=sr, onset_times=onset_times)
+    if frame_times is None:
+        import librosa
+
+        frame_times = librosa.frames_to_time(np.arange(len(pitches)), sr=sr)
+    base_notes = note_sequence_from_pitch_track(pitches, frame_times=frame_times, onset_times=onset_times)
 
     # prefer stem-derived materials when available
     drum_onsets = stems.get("drums", {}).get("onset_times", onset_times)
@@ -276,7 +271,7 @@ def build_strudel_result(
     lead = _lead_motif(vocal_notes or base_notes, root)
     rhythm = _drum_pattern(drum_onsets, tempo=tempo)
     bass = _bass_line(root, bass_notes=bass_notes)
-    preview = export_audio_clip(audio, sr=sr) if audio.size else None
+    preview = export_audio_clip(audio, sr=sr, base_dir=preview_dir) if audio.size else None
 
     return StrudelResult(
         tempo=tempo,